@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
-from __future__ import (unicode_literals, division, absolute_import,
-                        print_function)
 
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2020, Jim Miller'
@@ -9,19 +7,18 @@ __docformat__ = 'restructuredtext en'
 
 import os
 from contextlib import contextmanager
-import six
-from six import text_type as unicode
-
-from PyQt5.Qt import (QApplication, Qt, QIcon, QPixmap, QLabel, QDialog, QHBoxLayout,
-                      QTableWidgetItem, QFont, QLineEdit, QComboBox,
-                      QVBoxLayout, QDialogButtonBox, QStyledItemDelegate, QDateTime,
-                      QTextEdit,
-                      QListWidget, QAbstractItemView, QCursor)
+from functools import lru_cache
+
+# Keep the module-level Qt import down to what the get_icon/get_pixmap
+# fast path and the class definitions below need; the dialog-only
+# widgets are imported inside the dialogs that use them.
+from PyQt5.Qt import (QApplication, Qt, QByteArray, QIcon, QPixmap, QPixmapCache,
+                      QLabel, QDialog, QHBoxLayout, QTableWidgetItem, QFont,
+                      QCursor)
 from calibre.constants import numeric_version as calibre_version
 from calibre.constants import iswindows
 from calibre.gui2 import gprefs, error_dialog, UNDEFINED_QDATETIME, info_dialog
 from calibre.gui2.actions import menu_action_unique_name
-from calibre.gui2.keyboard import ShortcutConfig
 from calibre.utils.config import config_dir
 from calibre.utils.date import now, format_date, qt_to_dt, UNDEFINED_DATE
 
@@ -31,6 +28,14 @@ plugin_name = None
 # classes if you need any zip images to be displayed on the configuration dialog.
 plugin_icon_resources = {}
 
+# Qt's default pixmap cache is sized for general use; give it more
+# headroom (in KB) so our icons stay resident between lookups.
+QPixmapCache.setCacheLimit(10240)
+
+# QIcon construction from a QPixmap isn't free either, so keep the
+# QIcons we hand out around for reuse.
+_icon_cache = {}
+
 
 def set_plugin_icon_resources(name, resources):
     '''
@@ -41,6 +46,17 @@ def set_plugin_icon_resources(name, resources):
     global plugin_icon_resources, plugin_name
     plugin_name = name
     plugin_icon_resources = resources
+    # a plugin reload may have changed the images, so drop anything the
+    # pixmap/icon caches resolved against the old resources
+    get_pixmap.cache_clear()
+    _icon_cache.clear()
+    # decode the images now so the first toolbar/menu paint is all
+    # cache hits; going through get_pixmap keeps the usual resolution
+    # order, so user icons in resources/images/<plugin name>/ still win
+    # over the zip copies. QPixmap needs a QGuiApplication to exist.
+    if QApplication.instance() is not None:
+        for icon_name in resources:
+            get_pixmap(icon_name)
 
 # print_tracebacks_for_missing_resources first appears in cal 6.2.0
 if calibre_version >= (6,2,0):
@@ -92,10 +108,28 @@ def get_icon_old(icon_name):
 
 # get_icons changed in Cal6.
 if calibre_version >= (6,0,0):
-    get_icon = get_icon_6plus
+    _get_icon_impl = get_icon_6plus
 else:
-    get_icon = get_icon_old
+    _get_icon_impl = get_icon_old
+
+def get_icon(icon_name):
+    '''
+    Cached front end for the version specific get_icon implementations.
+    The same icons get requested for every menu/toolbar/dialog build, so
+    hand back the same QIcon instance each time.
+    '''
+    icon = _icon_cache.get(icon_name)
+    if icon is None:
+        icon = _get_icon_impl(icon_name)
+        # don't cache misses--the icon may become available later,
+        # e.g. once the plugin resources have been registered.
+        if icon is not None and not icon.isNull():
+            _icon_cache[icon_name] = icon
+    return icon
 
+# QPixmap isn't reentrant, but all callers are Qt slots on the GUI
+# thread, so a Python-side LRU in front of QPixmapCache is safe.
+@lru_cache(maxsize=128)
 def get_pixmap(icon_name):
     '''
     Retrieve a QPixmap for the named image
@@ -103,56 +137,90 @@ def get_pixmap(icon_name):
     '''
     global plugin_icon_resources, plugin_name
 
-    if not icon_name.startswith('images/'):
+    cache_key = 'epubsplit:' + icon_name
+    pixmap = QPixmap()
+    # two-arg form of find() for PyQt5 compatibility
+    if QPixmapCache.find(cache_key, pixmap):
+        return pixmap
+
+    if icon_name[:7] != 'images/':
         # We know this is definitely not an icon belonging to this plugin
-        pixmap = QPixmap()
         pixmap.load(I(icon_name))
+        if not pixmap.isNull():
+            QPixmapCache.insert(cache_key, pixmap)
         return pixmap
 
     # Check to see whether the icon exists as a Calibre resource
     # This will enable skinning if the user stores icons within a folder like:
     # ...\AppData\Roaming\calibre\resources\images\Plugin Name\
     if plugin_name:
-        local_images_dir = get_local_images_dir(plugin_name)
-        local_image_path = os.path.join(local_images_dir, icon_name.replace('images/', ''))
-        if os.path.exists(local_image_path):
-            pixmap = QPixmap()
-            pixmap.load(local_image_path)
-            return pixmap
+        basename = icon_name.split('/', 1)[1]
+        if basename in _get_local_image_names():
+            local_image_path = os.path.join(get_local_images_dir(plugin_name), basename)
+            # no exists() check--load() returns False if the file
+            # vanished between the directory scan and now.
+            if pixmap.load(local_image_path):
+                QPixmapCache.insert(cache_key, pixmap)
+                return pixmap
 
     # As we did not find an icon elsewhere, look within our zip resources
     if icon_name in plugin_icon_resources:
-        pixmap = QPixmap()
-        pixmap.loadFromData(plugin_icon_resources[icon_name])
-        return pixmap
+        if pixmap.loadFromData(plugin_icon_resources[icon_name]):
+            QPixmapCache.insert(cache_key, pixmap)
+            return pixmap
     return None
 
 
+# The user's override images dir almost never exists or changes while
+# calibre is running, so list its contents once.
+_local_image_names = None
+
+def _get_local_image_names():
+    global _local_image_names
+    if _local_image_names is None:
+        try:
+            _local_image_names = frozenset(e.name for e in os.scandir(get_local_images_dir(plugin_name)))
+        except FileNotFoundError:
+            _local_image_names = frozenset()
+    return _local_image_names
+
+
+# The set of directories asked for is bounded, so the joins (and the
+# normpath walk on Windows) only need to happen once per subfolder.
+_local_images_dir_cache = {}
+
 def get_local_images_dir(subfolder=None):
     '''
     Returns a path to the user's local resources/images folder
     If a subfolder name parameter is specified, appends this to the path
     '''
+    cached = _local_images_dir_cache.get(subfolder)
+    if cached is not None:
+        return cached
     images_dir = os.path.join(config_dir, 'resources/images')
     if subfolder:
         images_dir = os.path.join(images_dir, subfolder)
     if iswindows:
         images_dir = os.path.normpath(images_dir)
+    _local_images_dir_cache[subfolder] = images_dir
     return images_dir
 
 
 def get_library_uuid(db):
-    try:
-        library_uuid = db.library_id
-    except:
-        library_uuid = ''
-    return library_uuid
+    return getattr(db, 'library_id', '') or ''
+
+# QCursor construction needs a QGuiApplication, so build the shared
+# wait cursor lazily rather than at import time.
+_wait_cursor = None
 
 # Call as ' with busy_cursor:"
 @contextmanager
 def busy_cursor():
+    global _wait_cursor
+    if _wait_cursor is None:
+        _wait_cursor = QCursor(Qt.WaitCursor)
     try:
-        QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+        QApplication.setOverrideCursor(_wait_cursor)
         yield
     finally:
         QApplication.restoreOverrideCursor()
@@ -162,6 +230,10 @@ class ImageTitleLayout(QHBoxLayout):
     '''
     A reusable layout widget displaying an image followed by a title
     '''
+    # QFont is implicitly shared in Qt, so one instance can be reused by
+    # every titled dialog instead of hitting the font engine each time.
+    _title_font = None
+
     def __init__(self, parent, icon_name, title):
         QHBoxLayout.__init__(self)
         title_image_label = QLabel(parent)
@@ -176,10 +248,12 @@ class ImageTitleLayout(QHBoxLayout):
         title_image_label.setScaledContents(True)
         self.addWidget(title_image_label)
 
-        title_font = QFont()
-        title_font.setPointSize(16)
+        if ImageTitleLayout._title_font is None:
+            title_font = QFont()
+            title_font.setPointSize(16)
+            ImageTitleLayout._title_font = title_font
         shelf_label = QLabel(title, parent)
-        shelf_label.setFont(title_font)
+        shelf_label.setFont(ImageTitleLayout._title_font)
         self.addWidget(shelf_label)
         self.insertStretch(-1)
 
@@ -199,11 +273,11 @@ class SizePersistedDialog(QDialog):
         if self.geom is None:
             self.resize(self.sizeHint())
         else:
-            self.restoreGeometry(self.geom)
+            # accept bytes or bytearray from older saved prefs
+            self.restoreGeometry(QByteArray(self.geom))
 
     def dialog_closing(self, result):
-        geom = bytearray(self.saveGeometry())
-        gprefs[self.unique_pref_name] = geom
+        gprefs[self.unique_pref_name] = bytes(self.saveGeometry())
 
 
 class ReadOnlyTableWidgetItem(QTableWidgetItem):
@@ -245,6 +319,11 @@ class KeyboardConfigDialog(SizePersistedDialog):
     This dialog is used to allow editing of keyboard shortcuts.
     '''
     def __init__(self, gui, group_name):
+        from PyQt5.Qt import QVBoxLayout, QDialogButtonBox
+        # pulls in the whole keyboard config subsystem, so only pay for
+        # it when this dialog is actually opened
+        from calibre.gui2.keyboard import ShortcutConfig
+
         SizePersistedDialog.__init__(self, gui, 'Keyboard shortcut dialog')
         self.gui = gui
         self.setWindowTitle('Keyboard shortcuts')
@@ -291,6 +370,9 @@ class PrefsViewerDialog(SizePersistedDialog):
             self.keys_list.setCurrentRow(0)
 
     def _init_controls(self):
+        from PyQt5.Qt import (QVBoxLayout, QDialogButtonBox, QListWidget,
+                              QTextEdit, QAbstractItemView)
+
         layout = QVBoxLayout(self)
         self.setLayout(layout)
 
@@ -301,6 +383,9 @@ class PrefsViewerDialog(SizePersistedDialog):
         self.keys_list.setSelectionMode(QAbstractItemView.SingleSelection)
         self.keys_list.setFixedWidth(150)
         self.keys_list.setAlternatingRowColors(True)
+        # connect once here--connecting in _populate_settings stacked a
+        # duplicate slot invocation on every repopulate
+        self.keys_list.currentRowChanged[int].connect(self._current_row_changed)
         ml.addWidget(self.keys_list)
         self.value_text = QTextEdit(self)
         self.value_text.setReadOnly(True)
@@ -315,20 +400,32 @@ class PrefsViewerDialog(SizePersistedDialog):
         layout.addWidget(button_box)
 
     def _populate_settings(self):
-        self.keys_list.clear()
         ns_prefix = self._get_ns_prefix()
-        keys = sorted([k[len(ns_prefix):] for k in six.iterkeys(self.db.prefs)
-                       if k.startswith(ns_prefix)])
-        for key in keys:
-            self.keys_list.addItem(key)
-        self.keys_list.setMinimumWidth(self.keys_list.sizeHintForColumn(0))
-        self.keys_list.currentRowChanged[int].connect(self._current_row_changed)
+        plen = len(ns_prefix)
+        keys = sorted(k[plen:] for k in self.db.prefs
+                      if k.startswith(ns_prefix))
+        # one repaint and one batch of model signals for the whole
+        # clear-and-refill, not one per item
+        self.keys_list.setUpdatesEnabled(False)
+        self.keys_list.blockSignals(True)
+        self.keys_list.clear()
+        self.keys_list.addItems(keys)
+        self.keys_list.blockSignals(False)
+        self.keys_list.setUpdatesEnabled(True)
+        # blockSignals swallowed the currentRowChanged emission from
+        # clear(), so bring the value pane back in step by hand
+        self._current_row_changed(self.keys_list.currentRow())
+        # measure the keys we already have in hand instead of making Qt
+        # re-measure every item via sizeHintForColumn()
+        fm = self.keys_list.fontMetrics()
+        width = max((fm.horizontalAdvance(k) for k in keys), default=0) + 20
+        self.keys_list.setMinimumWidth(min(width, 300))
 
     def _current_row_changed(self, new_row):
         if new_row < 0:
             self.value_text.clear()
             return
-        key = unicode(self.keys_list.currentItem().text())
+        key = self.keys_list.currentItem().text()
         val = self.db.prefs.get_namespaced(self.namespace, key, '')
         self.value_text.setPlainText(self.db.prefs.to_raw(val))
 
@@ -344,8 +441,8 @@ class PrefsViewerDialog(SizePersistedDialog):
         if not confirm(message, self.namespace+'_clear_settings', self):
             return
         ns_prefix = self._get_ns_prefix()
-        keys = [k for k in six.iterkeys(self.db.prefs) if k.startswith(ns_prefix)]
-        for k in keys:
+        victims = [k for k in self.db.prefs if k.startswith(ns_prefix)]
+        for k in victims:
             del self.db.prefs[k]
         self._populate_settings()
         d = info_dialog(self, 'Settings deleted',